@@ -28,11 +28,15 @@
 
 import os
 import sys
+import threading
 import unittest
 from pprint import pprint
+from types import SimpleNamespace
+from unittest.mock import patch
 
 
 sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+import ukrainian_accentor_transformer
 from ukrainian_accentor_transformer import Accentor
 
 
@@ -54,6 +58,12 @@ class TestAccentor(unittest.TestCase):
         self.assertEqual(text1, accented1.replace("\u0301",""))
         self.assertEqual(text2, accented2.replace("\u0301",""))
 
+    def test_tuple_accent(self):
+        texts = ("Привіт хлопче, як справи.", "в мене все добре, дякую.")
+        accented = self.accentor(texts)
+        self.assertIsInstance(accented, list)
+        self.assertEqual(list(texts), [sentence.replace("\u0301","") for sentence in accented])
+
     def test_long_sentence(self):
         text = "Адже як би не оцінював галичан один страшно інтелігентний виходець з радянсько єврейських середовищ київського Подолу самі галичани вважають свою культуру і традицію політичну і релігійну побутову й господарську на голову вищою від усього що за Збручем"
         accented = self.accentor(text)
@@ -72,5 +82,231 @@ class TestAccentor(unittest.TestCase):
         for sentence, clean_sentence in zip(sentences, clean_sentences):
             self.assertEqual(sentence, clean_sentence)
 
+
+def stressed(text):
+    return text[0] + "\u0301" + text[1:]
+
+
+class FakeTranslator:
+    """Stresses the first token of each fragment and records every translated batch"""
+
+    def __init__(self):
+        self.batches = []
+        self.options = []
+
+    def translate_batch(self, batch, **kwargs):
+        self.batches.append(batch)
+        self.options.append(kwargs)
+        return [SimpleNamespace(hypotheses=[[stressed(tokens[0])] + tokens[1:]]) for tokens in batch]
+
+
+class FakeSentencePiece:
+    """Character level tokenizer with spaces as word boundary marks"""
+
+    def encode(self, sentences, out_type=str, num_threads=1):
+        if isinstance(sentences, str):
+            return self.encode([sentences])[0]
+        return [list(sentence.strip().replace(" ", "▁")) for sentence in sentences]
+
+    def decode(self, tokenized_sentences, num_threads=1):
+        return ["".join(tokens).replace("▁", " ") for tokens in tokenized_sentences]
+
+
+class FakeAccentor(Accentor):
+
+    def _init_model(self, **kwargs):
+        self.model = FakeTranslator()
+        self.sp = FakeSentencePiece()
+
+
+class TestAccentorInternals(unittest.TestCase):
+
+    def setUp(self):
+        self.accentor = FakeAccentor()
+
+    def test_cache_duplicates_in_call(self):
+        self.accentor(["мама", "тато", "мама"])
+        self.assertEqual(self.accentor.model.batches, [[list("мама"), list("тато")]])
+
+    def test_cache_hits_across_calls(self):
+        self.accentor("мама")
+        self.accentor(["мама", "тато"])
+        self.assertEqual(self.accentor.model.batches, [[list("мама")], [list("тато")]])
+
+    def test_cache_lru_eviction(self):
+        self.accentor.cache_size = 2
+        self.accentor(["мама", "тато", "баба"])
+        self.assertEqual(list(self.accentor._cache), [tuple("тато"), tuple("баба")])
+        self.accentor("тато")
+        self.accentor("мама")
+        self.assertEqual(self.accentor.model.batches[-1], [list("мама")])
+        self.assertEqual(list(self.accentor._cache), [tuple("тато"), tuple("мама")])
+
+    def test_cache_shared_between_threads(self):
+        self.accentor.cache_size = 3
+        words = ["мама", "тато", "баба", "діду", "брате", "сину", "доню"]
+        errors = []
+
+        def accent(shift):
+            try:
+                for _ in range(50):
+                    sentences = words[shift:] + words[:shift]
+                    self.assertEqual(self.accentor(sentences), [stressed(word) for word in sentences])
+            except Exception as e:
+                errors.append(e)
+
+        # switch threads as often as possible to expose races
+        switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        try:
+            threads = [threading.Thread(target=accent, args=(shift % len(words),)) for shift in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            sys.setswitchinterval(switch_interval)
+        self.assertEqual(errors, [])
+        self.assertLessEqual(len(self.accentor._cache), 3)
+
+    def test_passthrough(self):
+        accented = self.accentor(["123, 456!", "...", "мама 2"])
+        self.assertEqual(accented, ["123, 456!", "...", stressed("мама 2")])
+        self.assertEqual(self.accentor.model.batches, [[list("мама▁2")]])
+        self.assertNotIn(tuple("123,"), self.accentor._cache)
+
+    def test_order_across_chunks(self):
+        sentences = ["мама", "тато", "баба", "діду", "сину"]
+        accented = self.accentor(sentences, chunk_size=2)
+        self.assertEqual(accented, [stressed(sentence) for sentence in sentences])
+        self.assertEqual(len(self.accentor.model.batches), 3)
+
+    def test_invalid_chunk_size(self):
+        for chunk_size in (0, -1):
+            with self.assertRaises(ValueError):
+                self.accentor("мама", chunk_size=chunk_size)
+            with self.assertRaises(ValueError):
+                self.accentor(["мама"], chunk_size=chunk_size)
+
+    def _patch_model_loading(self):
+        Accentor.clear_model_cache()
+        self.addCleanup(Accentor.clear_model_cache)
+        patches = [
+            patch.object(Accentor, "_download_huggingface", return_value="/repo"),
+            patch("ukrainian_accentor_transformer.ctranslate2.Translator",
+                  side_effect=lambda *args, **kwargs: SimpleNamespace(args=args, kwargs=kwargs)),
+            patch("ukrainian_accentor_transformer.spm.SentencePieceProcessor",
+                  side_effect=lambda **kwargs: SimpleNamespace(**kwargs)),
+        ]
+        mocks = [patcher.start() for patcher in patches]
+        for patcher in patches:
+            self.addCleanup(patcher.stop)
+        return mocks[1:]
+
+    def test_model_cache(self):
+        translator, processor = self._patch_model_loading()
+        first = Accentor(warmup=False)
+        second = Accentor(warmup=False)
+        self.assertIs(first.model, second.model)
+        self.assertIs(first.sp, second.sp)
+        self.assertEqual(translator.call_count, 1)
+
+        other = Accentor(inter_threads=1, warmup=False)
+        self.assertIsNot(other.model, first.model)
+        self.assertIs(other.sp, first.sp)
+        self.assertEqual(translator.call_count, 2)
+        self.assertEqual(processor.call_count, 1)
+
+    def test_model_cache_eviction(self):
+        translator, _ = self._patch_model_loading()
+        size = ukrainian_accentor_transformer._MODEL_CACHE_SIZE
+        models = [Accentor(inter_threads=threads, warmup=False).model for threads in range(1, size + 1)]
+        # reuse moves the oldest model to the end, so the second one is evicted next
+        self.assertIs(Accentor(inter_threads=1, warmup=False).model, models[0])
+        Accentor(inter_threads=size + 1, warmup=False)
+        self.assertEqual(len(ukrainian_accentor_transformer._MODEL_CACHE), size)
+        self.assertIs(Accentor(inter_threads=1, warmup=False).model, models[0])
+        self.assertIsNot(Accentor(inter_threads=2, warmup=False).model, models[1])
+        self.assertEqual(translator.call_count, size + 2)
+
+        Accentor.clear_model_cache()
+        self.assertEqual(len(ukrainian_accentor_transformer._MODEL_CACHE), 0)
+        self.assertEqual(len(ukrainian_accentor_transformer._SP_CACHE), 0)
+        self.assertIsNot(Accentor(inter_threads=1, warmup=False).model, models[0])
+
+    def test_device_config(self):
+        translator, _ = self._patch_model_loading()
+        cpu_count = os.cpu_count() or 1
+
+        accentor = Accentor(warmup=False)
+        self.assertEqual(translator.call_args[1],
+                         {"device": "cpu", "inter_threads": 2, "intra_threads": max(1, cpu_count // 2)})
+        self.assertEqual(accentor._run_config["max_batch_size"], 8)
+        self.assertNotIn("beam_size", accentor._run_config)
+
+        accentor = Accentor(inter_threads=3, compute_type="int8", max_batch_size=16, beam_size=1, warmup=False)
+        self.assertEqual(translator.call_args[1],
+                         {"device": "cpu", "inter_threads": 3, "intra_threads": max(1, cpu_count // 3),
+                          "compute_type": "int8"})
+        self.assertEqual(accentor._run_config["max_batch_size"], 16)
+        self.assertEqual(accentor._run_config["beam_size"], 1)
+
+        accentor = Accentor(device="cuda", warmup=False)
+        self.assertEqual(translator.call_args[1], {"device": "cuda", "inter_threads": 1, "intra_threads": 1})
+        self.assertEqual(accentor._run_config["max_batch_size"], 64)
+
+        accentor = Accentor(device="cuda", inter_threads=2, intra_threads=4, compute_type="int8_float16",
+                            max_batch_size=32, warmup=False)
+        self.assertEqual(translator.call_args[1],
+                         {"device": "cuda", "inter_threads": 2, "intra_threads": 4, "compute_type": "int8_float16"})
+        self.assertEqual(accentor._run_config["max_batch_size"], 32)
+
+    def test_warmup_uses_run_config(self):
+        translator, processor = self._patch_model_loading()
+        translator.side_effect = lambda *args, **kwargs: FakeTranslator()
+        processor.side_effect = lambda **kwargs: FakeSentencePiece()
+        with patch.dict(os.environ):
+            os.environ.pop("CT2_USE_EXPERIMENTAL_PACKED_GEMM", None)
+            accentor = Accentor(beam_size=1, max_batch_size=4)
+            self.assertNotIn("CT2_USE_EXPERIMENTAL_PACKED_GEMM", os.environ)
+        self.assertEqual(accentor.model.batches, [[list("Привіт")]])
+        self.assertEqual(accentor.model.options, [{**accentor._run_config, "max_batch_size": 1}])
+        self.assertEqual(accentor.model.options[0]["beam_size"], 1)
+
+    def test_packed_gemm_option(self):
+        self._patch_model_loading()
+        with patch.dict(os.environ):
+            os.environ.pop("CT2_USE_EXPERIMENTAL_PACKED_GEMM", None)
+            Accentor(packed_gemm=True, warmup=False)
+            self.assertEqual(os.environ["CT2_USE_EXPERIMENTAL_PACKED_GEMM"], "1")
+
+    def test_download_cache(self):
+        Accentor._download_huggingface.cache_clear()
+        self.addCleanup(Accentor._download_huggingface.cache_clear)
+        with patch("ukrainian_accentor_transformer.snapshot_download", return_value="/repo") as download:
+            self.assertEqual(Accentor._download_huggingface("user/repo@v1"), "/repo")
+            self.assertEqual(Accentor._download_huggingface("user/repo@v1"), "/repo")
+        download.assert_called_once_with("user/repo", revision="v1")
+
+    def test_split_punctuation(self):
+        self.assertEqual(self.accentor._split_punctuation("Привіт хлопче, як справи... Добре!\n"),
+                         ["Привіт хлопче,", " як справи...", " Добре!"])
+        self.assertEqual(self.accentor._split_punctuation("Привіт,друже"), ["Привіт,", "друже"])
+        self.assertEqual(self.accentor._split_punctuation("без розділових знаків"), ["без розділових знаків"])
+
+    def test_custom_split_tokens(self):
+        self.accentor.split_tokens = {";", "..."}
+        self.assertEqual(self.accentor._split_punctuation("так; ні... може, так"),
+                         ["так;", " ні...", " може, так"])
+        self.accentor.split_tokens = set()
+        self.assertEqual(self.accentor._split_punctuation("так, ні"), ["так, ні"])
+
+    def test_empty_sentences(self):
+        sentences = ["", "   ", "\n", "мама"]
+        translation_batch, join_list = self.accentor._to_translation_batch(sentences)
+        self.assertEqual(join_list, [0, 0, 0, 1])
+        self.assertEqual(translation_batch, [list("мама")])
+        self.assertEqual(self.accentor(sentences), ["", "   ", "\n", stressed("мама")])
+
 if __name__ == '__main__':
     unittest.main()
@@ -27,7 +27,13 @@
 # SOFTWARE,  EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 
-from typing import List, Union, Tuple
+import os
+import re
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from itertools import chain
+from typing import List, Union, Tuple, Optional, Dict, Iterable, FrozenSet, Pattern
 
 from huggingface_hub import snapshot_download
 import sentencepiece as spm
@@ -36,15 +42,25 @@ import ctranslate2
 from .sequence_utils import diff_fix
 
 
+# loaded translators, least recently used first
+_MODEL_CACHE: "OrderedDict[tuple, ctranslate2.Translator]" = OrderedDict()
+_MODEL_CACHE_SIZE = 4
+_SP_CACHE: Dict[str, spm.SentencePieceProcessor] = {}
+# guards both caches when instances are created from several threads
+_MODEL_CACHE_LOCK = threading.Lock()
+
+
 class Accentor:
     _hf_repo = "NeonBohdan/ukrainian-accentor-transformer@v0.1"
     
     max_len = 30
-    split_tokens = set([".",",","!","?"])
+    cache_size = 10000
+    split_tokens = frozenset([".",",","!","?"])
+    _accent_table = str.maketrans("", "", "\u0301")
+    _accentable_pattern = re.compile("[а-яіїєґА-ЯІЇЄҐ]")
 
     _init_config = {
-        "inter_threads": 2, 
-        "intra_threads": 4
+        "inter_threads": 2
     }
 
     _run_config = {
@@ -52,15 +68,59 @@ class Accentor:
         "max_batch_size": 8
     }
 
-    def __init__(self, device: str = "cpu"):
-        self._init_model(device = device)
+    # overrides for gpu, where threads do not matter and larger batches pay off
+    _cuda_init_config = {
+        "inter_threads": 1,
+        "intra_threads": 1
+    }
 
-    def __call__(self, sentence: Union[List[str],str],
-                        symbol: str = "stress", mode: str = "reduced") -> Union[List[str],str]:
+    _cuda_run_config = {
+        "max_batch_size": 64
+    }
+
+    def __init__(self, device: str = "cpu", compute_type: Optional[str] = None,
+                        inter_threads: Optional[int] = None, intra_threads: Optional[int] = None,
+                        max_batch_size: Optional[int] = None, beam_size: Optional[int] = None,
+                        disable_unk: bool = False, warmup: bool = True, packed_gemm: bool = False):
+        """
+        Load the accent model
+        Args:
+            device: device where to run model: "cpu" or "cuda"
+            compute_type: model weights quantization, e.g. "int8" on cpu or "int8_float16" on cuda,
+                the type the model was saved with by default
+            inter_threads: number of batches translated in parallel, 2 on cpu and 1 on cuda by default
+            intra_threads: threads per batch, on cpu all cores are shared between inter_threads by default
+            max_batch_size: maximum number of fragments translated at once, 8 on cpu and 64 on cuda by default
+            beam_size: beam search width, 1 for greedy decoding, CTranslate2 default if not set
+            disable_unk: forbid the unknown token in model output
+            warmup: run a dummy translation after loading to move first-call overhead out of inference
+            packed_gemm: set CT2_USE_EXPERIMENTAL_PACKED_GEMM=1 before loading, it affects float32 models only
+                and applies to every CTranslate2 model in the process, an existing value is kept
+        """
+        run_config = dict(self._run_config)
+        if device == "cuda":
+            run_config.update(self._cuda_run_config)
+        if max_batch_size is not None:
+            run_config["max_batch_size"] = max_batch_size
+        if beam_size is not None:
+            run_config["beam_size"] = beam_size
+        if disable_unk:
+            run_config["disable_unk"] = True
+        self._run_config = run_config
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self._init_model(device = device, compute_type = compute_type,
+                        inter_threads = inter_threads, intra_threads = intra_threads,
+                        warmup = warmup, packed_gemm = packed_gemm)
+
+    def __call__(self, sentence: Union[Iterable[str],str],
+                        symbol: str = "stress", mode: str = "reduced",
+                        chunk_size: int = 2000) -> Union[List[str],str]:
         """
         Add word stress to texts in Ukrainian
         Args:
             sentence: sentence to accent
+            chunk_size: number of sentences processed at once, bounds memory for large inputs
 
         Returns:
             accented_sentence
@@ -73,19 +133,18 @@ class Accentor:
             >>> accented_sentence = accentor("Привіт хлопче")
         """
 
-        if (type(sentence) is str):
-            sentences = [sentence]
-        elif (type(sentence) is list):
-            sentences = sentence
+        if (chunk_size < 1):
+            raise ValueError(f"chunk_size must be positive, got {chunk_size}")
 
-        accented_sentences = self._accent(sentences=sentences, symbol=symbol, mode=mode)
+        is_single = isinstance(sentence, str)
+        sentences = [sentence] if is_single else list(sentence)
 
-        if (type(sentence) is str):
-            accented_sentence = accented_sentences[0]
-        elif (type(sentence) is list):
-            accented_sentence = accented_sentences
+        accented_sentences = []
+        for chunk_idx in range(0, len(sentences), chunk_size):
+            chunk = sentences[chunk_idx:chunk_idx + chunk_size]
+            accented_sentences += self._accent(sentences=chunk, symbol=symbol, mode=mode)
 
-        return accented_sentence
+        return accented_sentences[0] if is_single else accented_sentences
 
     def _accent(self, sentences: List[str], symbol: str, mode: str) -> List[str]:
         """
@@ -99,66 +158,60 @@ class Accentor:
      
         clean_sentences = self._clean_accents(sentences)
 
-        tokenized_sentences = self.sp.encode(clean_sentences, out_type=str)
-        splitted_sentences = self._split_punctuation(tokenized_sentences)
-        short_sentences = self._split_long(splitted_sentences)
-
-        translation_batch, join_list = self._to_translation_batch(short_sentences)
-        results = self.model.translate_batch(translation_batch, **self._run_config)
-        accented_tokens = [result.hypotheses[0] for result in results]
+        translation_batch, join_list = self._to_translation_batch(clean_sentences)
+        accented_tokens = self._translate_cached(translation_batch)
 
         join_sentences = self._join_long(accented_tokens, join_list)
-        accented_sentences = self.sp.decode(join_sentences)
+        accented_sentences = self._decode(join_sentences)
 
         fixed_sentences = self._diff_fix(clean_sentences, accented_sentences)
 
         return fixed_sentences
 
+    def _encode(self, sentences: List[str]) -> List[List[str]]:
+        num_threads = self._sp_num_threads(len(sentences))
+        try:
+            return self.sp.encode(sentences, out_type=str, num_threads=num_threads)
+        except TypeError:
+            # sentencepiece < 0.1.99 has no num_threads
+            return self.sp.encode(sentences, out_type=str)
+
+    def _decode(self, tokenized_sentences: List[List[str]]) -> List[str]:
+        num_threads = self._sp_num_threads(len(tokenized_sentences))
+        try:
+            return self.sp.decode(tokenized_sentences, num_threads=num_threads)
+        except TypeError:
+            return self.sp.decode(tokenized_sentences)
+
+    @staticmethod
+    def _sp_num_threads(batch_len: int) -> int:
+        return max(1, min(batch_len, os.cpu_count() or 1))
+
     def _clean_accents(self, sentences: List[str]) -> List[str]:
-        clean_sentences = [sentence.replace("\u0301","") for sentence in sentences]
+        clean_sentences = [sentence.translate(self._accent_table) for sentence in sentences]
         return clean_sentences
 
-    def _split_punctuation(self, tokenized_sentences: List[List[str]]) -> List[List[List[str]]]:
-        splitted_sentences = []
-        for tokenized in tokenized_sentences:
-            splitted = self._split_punctuation_sentence(tokenized)
-            splitted_sentences.append(splitted)
-        return splitted_sentences
-
-    def _split_punctuation_sentence(self, tokenized: List[str]) -> List[List[str]]:
-        splitted = []
-        start_idx = 0
-        for idx, token in enumerate(tokenized, start = 1):
-            if token in self.split_tokens:
-                splitted.append(tokenized[start_idx:idx])
-                start_idx = idx
+    def _split_punctuation(self, sentence: str) -> List[str]:
+        if self.split_tokens:
+            # odd items are runs of split tokens, glue each to the end of the preceding text
+            parts = self._split_pattern(frozenset(self.split_tokens)).split(sentence) + [""]
+            splitted = [text + tokens for text, tokens in zip(parts[::2], parts[1::2])]
         else:
-            if (start_idx < len(tokenized)):
-                splitted.append(tokenized[start_idx:])
-        return splitted
-
-    def _split_long(self, splitted_sentences: List[List[List[str]]]) -> List[List[List[str]]]:
-        while True:
-            short_sentences = []
-            for tokenized in splitted_sentences:
-                short = self._split_long_sentence(tokenized)
-                short_sentences.append(short)
-            if splitted_sentences == short_sentences:
-                break
-            else:
-                splitted_sentences = short_sentences
-        return short_sentences
-
-    def _split_long_sentence(self, splitted: List[List[str]]) -> List[List[str]]:
-        short = []
-        for sentence in splitted:
-            if (len(sentence) < self.max_len):
-                short.append(sentence)
-            else:
-                middle_idx = self._find_middle_space(sentence)
-                short.append(sentence[:middle_idx])
-                short.append(sentence[middle_idx:])
-        return short
+            splitted = [sentence]
+        # whitespace-only chunks are dropped, diff_fix restores them afterwards
+        return [chunk for chunk in splitted if chunk.strip()]
+
+    @staticmethod
+    @lru_cache(maxsize=8)
+    def _split_pattern(split_tokens: FrozenSet[str]) -> Pattern:
+        alternatives = "|".join(re.escape(token) for token in sorted(split_tokens, key=len, reverse=True))
+        return re.compile(f"((?:{alternatives})+)")
+
+    def _split_long_sentence(self, sentence: List[str]) -> List[List[str]]:
+        if (len(sentence) < self.max_len):
+            return [sentence]
+        middle_idx = self._find_middle_space(sentence)
+        return self._split_long_sentence(sentence[:middle_idx]) + self._split_long_sentence(sentence[middle_idx:])
 
     @staticmethod
     def _find_middle_space(sentence: List[str]) -> int:
@@ -174,16 +227,65 @@ class Accentor:
         else:
             return middle_idx
 
-    def _to_translation_batch(self, splitted_sentences: List[List[List[str]]]) -> Tuple[List[List[str]], List[int]]:
-        join_list = [len(sentence) for sentence in splitted_sentences]
-        translation_batch = sum(splitted_sentences, [])
+    def _to_translation_batch(self, sentences: List[str]) -> Tuple[List[List[str]], List[int]]:
+        chunks = []
+        chunk_counts = [0] * len(sentences)
+        for idx, sentence in enumerate(sentences):
+            splitted = self._split_punctuation(sentence)
+            chunks.extend(splitted)
+            chunk_counts[idx] = len(splitted)
+
+        tokenized_chunks = self._encode(chunks)
+
+        translation_batch = []
+        join_list = [0] * len(sentences)
+        chunk_idx = 0
+        for idx, chunk_count in enumerate(chunk_counts):
+            start_len = len(translation_batch)
+            for tokenized in tokenized_chunks[chunk_idx:chunk_idx + chunk_count]:
+                translation_batch.extend(self._split_long_sentence(tokenized))
+            join_list[idx] = len(translation_batch) - start_len
+            chunk_idx += chunk_count
         return translation_batch, join_list
 
+    def _translate_cached(self, translation_batch: List[List[str]]) -> List[List[str]]:
+        keys = [tuple(tokens) for tokens in translation_batch]
+        unique_keys = list(dict.fromkeys(keys))
+
+        # one instance may be shared between threads, the translator itself is thread-safe
+        with self._cache_lock:
+            accented = {}
+            for key in unique_keys:
+                if key in self._cache:
+                    self._cache.move_to_end(key)
+                    accented[key] = self._cache[key]
+
+        # fragments not seen before, in order of appearance
+        uncached = [key for key in unique_keys if (key not in accented) and self._is_accentable(key)]
+
+        translated = {}
+        if uncached:
+            results = self.model.translate_batch([list(key) for key in uncached], **self._run_config)
+            translated = {key: result.hypotheses[0] for key, result in zip(uncached, results)}
+
+            with self._cache_lock:
+                self._cache.update(translated)
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        accented.update(translated)
+
+        # fragments with nothing to accent, e.g. punctuation or numbers, are passed through
+        accented_tokens = [accented[key] if key in accented else list(key) for key in keys]
+        return accented_tokens
+
+    def _is_accentable(self, tokens: Tuple[str, ...]) -> bool:
+        return any(self._accentable_pattern.search(token) for token in tokens)
+
     def _join_long(self, splitted_sentences: List[List[str]], join_list: List[int]) -> List[List[str]]:
         join_sentences = []
         sentence_idx = 0
         for join_len in join_list:
-            sentence = sum(splitted_sentences[sentence_idx:sentence_idx + join_len], [])
+            sentence = list(chain.from_iterable(splitted_sentences[sentence_idx:sentence_idx + join_len]))
             join_sentences.append(sentence)
             sentence_idx += join_len
         return join_sentences
@@ -194,18 +296,78 @@ class Accentor:
         return fixed_sentences
         
 
-    def _init_model(self, device: str) -> None:
+    def _init_model(self, device: str, compute_type: Optional[str] = None,
+                        inter_threads: Optional[int] = None, intra_threads: Optional[int] = None,
+                        warmup: bool = True, packed_gemm: bool = False) -> None:
         """
         Initialize a model and tokenizer
         Args:
             device: device where to run model: "cpu" or "cuda"
+            compute_type: model weights quantization, e.g. "int8" on cpu or "int8_float16" on cuda,
+                the type the model was saved with by default
+            inter_threads: number of batches translated in parallel
+            intra_threads: threads per batch, all cpu cores are shared between inter_threads by default
+            warmup: run a dummy translation after loading to move first-call overhead out of inference
+            packed_gemm: set CT2_USE_EXPERIMENTAL_PACKED_GEMM=1 before loading, it affects float32 models only
+                and applies to every CTranslate2 model in the process, an existing value is kept
         """
         repo_path = self._download_huggingface(self._hf_repo)
 
-        self.model = ctranslate2.Translator(f"{repo_path}/ctranslate2/", device=device, **self._init_config)
-        self.sp = spm.SentencePieceProcessor(model_file=f"{repo_path}/tokenizer.model")
+        init_config = dict(self._init_config)
+        if device == "cuda":
+            init_config.update(self._cuda_init_config)
+        if compute_type is not None:
+            init_config["compute_type"] = compute_type
+        if inter_threads is not None:
+            init_config["inter_threads"] = inter_threads
+        if intra_threads is not None:
+            init_config["intra_threads"] = intra_threads
+        elif "intra_threads" not in init_config:
+            init_config["intra_threads"] = max(1, (os.cpu_count() or 1) // init_config["inter_threads"])
+
+        sp_path = f"{repo_path}/tokenizer.model"
+        cache_key = (repo_path, device, init_config.get("compute_type"),
+                        init_config["inter_threads"], init_config["intra_threads"])
+        with _MODEL_CACHE_LOCK:
+            # tokenizer does not depend on device or threads, so it is shared by all models of a repo
+            if sp_path not in _SP_CACHE:
+                _SP_CACHE[sp_path] = spm.SentencePieceProcessor(model_file=sp_path)
+            self.sp = _SP_CACHE[sp_path]
+
+            if cache_key not in _MODEL_CACHE:
+                if packed_gemm:
+                    os.environ.setdefault("CT2_USE_EXPERIMENTAL_PACKED_GEMM", "1")
+                # Translator is thread-safe, so loaded models are shared between instances
+                model = ctranslate2.Translator(f"{repo_path}/ctranslate2/", device=device, **init_config)
+                if warmup:
+                    self._warmup(model)
+                _MODEL_CACHE[cache_key] = model
+                while len(_MODEL_CACHE) > _MODEL_CACHE_SIZE:
+                    _MODEL_CACHE.popitem(last=False)
+            _MODEL_CACHE.move_to_end(cache_key)
+            self.model = _MODEL_CACHE[cache_key]
+
+    @staticmethod
+    def clear_model_cache() -> None:
+        """
+        Release models and tokenizers shared between instances,
+        models stay alive only while some Accentor still uses them
+        """
+        with _MODEL_CACHE_LOCK:
+            _MODEL_CACHE.clear()
+            _SP_CACHE.clear()
+
+    def _warmup(self, model: ctranslate2.Translator) -> None:
+        # same decoding options as real calls, so the same code path is warmed up
+        run_config = {**self._run_config, "max_batch_size": 1}
+        try:
+            model.translate_batch([self.sp.encode("Привіт", out_type=str)], **run_config)
+        except Exception:
+            # warmup is only an optimization, a failure here will surface on the first real call
+            pass
 
     @staticmethod
+    @lru_cache(maxsize=4)
     def _download_huggingface(repo_name: str) -> str:
         """
         Download a file from Huggingface